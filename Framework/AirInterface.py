@@ -22,6 +22,8 @@ class AirInterface:
         self.prop_model = prop_model
         self.snr_model = snr_model
         self.env = env
+        # nodes are stationary, so the node <-> gateway distance is computed only once
+        self._distance_cache = dict()
 
     @staticmethod
     def frequency_collision(p1: UplinkMessage, p2: UplinkMessage):
@@ -184,8 +186,11 @@ class AirInterface:
 
         from_node = packet.node
         node_id = from_node.id
-        rss = self.prop_model.tp_to_rss(from_node.location.indoor, packet.lora_param.tp,
-                                        Location.distance(self.gateway.location, packet.node.location))
+        distance = self._distance_cache.get(node_id)
+        if distance is None:
+            distance = Location.distance(self.gateway.location, from_node.location)
+            self._distance_cache[node_id] = distance
+        rss = self.prop_model.tp_to_rss(from_node.location.indoor, packet.lora_param.tp, distance)
         if node_id not in self.prop_measurements:
             self.prop_measurements[node_id] = {'rss': [], 'snr': [], 'time': []}
         packet.rss = rss
@@ -1,11 +1,101 @@
-from collections import deque  # circular buffer for storing SNR history for the ADR algorithm
+from collections import defaultdict, deque
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
 
 from Framework.LoRaPacket import UplinkMessage, DownlinkMetaMessage, DownlinkMessage
 from Framework.LoRaParameters import LoRaParameters
 from GlobalConfig import *
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the ADR kernel runs as plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+
+        return decorator
+
+
+@njit(cache=True)
+def _adr_kernel(snr_history_val, adr_required_snr, adr_margin_db, current_tx_power, current_dr):
+    # scalar math core of the ADR algorithm, kept free of object
+    # attribute access so numba can compile it
+    snr_margin = snr_history_val - adr_required_snr - adr_margin_db
+
+    # int(round(...)) keeps the step count a plain int, so the comparisons
+    # and arithmetic below do not drag a boxed NumPy scalar along
+    num_steps = int(round(snr_margin / 3.0))
+    # If NStep > 0 the data rate can be increased and/or power reduced.
+    # If Nstep < 0, power can be increased (to the max.).
+
+    # Note: the data rate is never decreased,
+    # this is done automatically by the node if ADRACKReq's get unacknowledged.
+
+    dr_changing = 0
+    new_tx_power = current_tx_power
+    new_dr = current_dr
+
+    if num_steps > 0:
+        # increase data rate by the num_steps until DR5 is reached
+        num_steps_possible_dr = 5 - current_dr
+        if num_steps > num_steps_possible_dr:
+            dr_changing = num_steps_possible_dr
+            num_steps_remaining = num_steps - num_steps_possible_dr
+            decrease_tx_power = num_steps_remaining * 3  # the remainder is used  to decrease the TXpower by
+            # 3dBm per step, until TXmin is reached. TXmin = 2 dBm for EU868.
+            new_tx_power = max(current_tx_power - decrease_tx_power, 2)
+        elif num_steps <= num_steps_possible_dr:
+            dr_changing = num_steps
+            # use default decrease tx power (0)
+        new_dr = current_dr + dr_changing
+    elif num_steps < 0:
+        # TX power is increased by 3dBm per step, until TXmax is reached (=14 dBm for EU868).
+        num_steps = - num_steps  # invert so we do not need to work with negative numbers
+        new_tx_power = min(current_tx_power + (num_steps * 3), 14)
+
+    return new_dr, new_tx_power
+
+
+# required SNR for the ADR algorithm, indexed by SF
+_ADR_REQ_SNR = {7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
+
+# sensitivity indexed by (sf - 6); the tuple serves the scalar path with a
+# plain C-level index instead of a dict hash lookup, the arrays serve the
+# batch path so it can classify weak packets in one vector op
+_SENSITIVITY_TUPLE = (-121, -126.5, -129, -131.5, -134, -136.5, -139.5)
+_SENSITIVITY_ARR = np.array(_SENSITIVITY_TUPLE)
+# required SNR indexed by DR
+_REQUIRED_SNR_ARR = np.array([-20.0, -17.5, -15.0, -12.5, -10.0, -7.5])
+
+# DL RX window selection, keyed by (dr > 3, RX1 possible, RX2 possible)
+# with DR > 3 we would like sending on the same channel with the same DR (RX1)
+# otherwise we would like sending it on RX2 (less robust) but sending with 27dBm
+_RX_DECISION = {
+    # (dr > 3, rx1, rx2): (tx_on_rx1, lost)
+    (True, True, True): (True, False),
+    (True, True, False): (True, False),
+    (True, False, True): (False, False),
+    (True, False, False): (False, True),
+    (False, True, True): (False, False),
+    (False, True, False): (True, False),
+    (False, False, True): (False, False),
+    (False, False, False): (False, True),
+}
+
+
+@lru_cache(maxsize=128)
+def _time_on_air_cached(payload_size, sf, freq):
+    # (payload_size, sf, freq) only takes a handful of distinct values,
+    # so the airtime formula and the LoRaParameters allocation
+    # are computed only once per combination
+    from Framework import LoRaPacket
+    return LoRaPacket.time_on_air(payload_size,
+                                  lora_param=LoRaParameters(freq=freq, sf=sf, bw=125, cr=5, crc_enabled=1,
+                                                            de_enabled=0, header_implicit_mode=1))
+
 
 def required_snr(dr):
     req_snr = 0
@@ -28,22 +118,40 @@ def required_snr(dr):
 
 
 class Gateway:
+    # __slots__ makes the heavy per-packet attribute access a C-level slot
+    # load and shrinks the instance (no per-instance __dict__)
+    __slots__ = ('bytes_received', 'location', 'packet_history', 'packet_history_idx', 'packet_history_count',
+                 '_snr_max_window', 'packet_num_received_from', 'distinct_packets_received',
+                 'distinct_bytes_received_from', 'last_distinct_packets_received_from', '_channel_idx', 'time_off',
+                 'dl_not_schedulable', 'uplink_packet_weak_count', 'num_of_packet_received', 'env', 'adr_margin_db',
+                 'fast_adr_on', 'max_snr_adr', 'min_snr_adr', 'avg_snr_adr', 'prop_measurements', '_rx2_toa')
+
     SENSITIVITY = {6: -121, 7: -126.5, 8: -129, 9: -131.5, 10: -134, 11: -136.5, 12: -139.5}
 
     def __init__(self, env, location, fast_adr_on=False, max_snr_adr=True, min_snr_adr=False, avg_snr_adr=False,
                  adr_margin_db=10):
         self.bytes_received = 0
         self.location = location
-        self.packet_history = dict()
-        self.packet_num_received_from = dict()
+        # per-node circular buffer with the SNR history for the ADR algorithm
+        # defaultdicts so the first packet of a node needs no membership test
+        self.packet_history = defaultdict(lambda: np.full(20, np.nan, dtype=np.float32))
+        self.packet_history_idx = defaultdict(int)
+        self.packet_history_count = defaultdict(int)
+        # monotonic deque of (snr, seq) per node over the same 20-sample
+        # window; the front always holds the running maximum
+        self._snr_max_window = defaultdict(deque)
+        self.packet_num_received_from = defaultdict(int)
         self.distinct_packets_received = 0
-        self.distinct_bytes_received_from = dict()
+        self.distinct_bytes_received_from = defaultdict(int)
         self.last_distinct_packets_received_from = dict()
-        self.time_off = dict()
-        for channel in LoRaParameters.CHANNELS:
-            self.time_off[channel] = 0
+        # per-channel DL off-time in a preallocated array, so updating a
+        # channel is a single indexed store instead of a dict insert
+        self._channel_idx = {channel: idx for idx, channel in enumerate(LoRaParameters.CHANNELS)}
+        self.time_off = np.zeros(len(self._channel_idx))
         self.dl_not_schedulable = 0
-        self.uplink_packet_weak = []
+        # only the number of weak packets is ever reported, so a counter
+        # suffices and the packet objects are not pinned in memory
+        self.uplink_packet_weak_count = 0
         self.num_of_packet_received = 0
         self.env = env
 
@@ -56,7 +164,11 @@ class Gateway:
 
         self.prop_measurements = {}
 
-    def packet_received(self, from_node, packet: UplinkMessage, now):
+        # the RX2 window always uses the same payload, SF and channel,
+        # so its airtime is a constant for the whole simulation
+        self._rx2_toa = _time_on_air_cached(12, LoRaParameters.RX_2_DEFAULT_SF, LoRaParameters.RX_2_DEFAULT_FREQ)
+
+    def packet_received(self, from_node, packet: UplinkMessage, now, weak=None):
 
         downlink_meta_msg = DownlinkMetaMessage()
         downlink_msg = DownlinkMessage(dmm=downlink_meta_msg)
@@ -69,92 +181,107 @@ class Gateway:
         In addition, the gateway determines the best suitable DL Rx window.
         """
 
-        if from_node.id not in self.packet_history:
-            self.packet_history[from_node.id] = deque(maxlen=20)
-            self.packet_num_received_from[from_node.id] = 0
-            self.distinct_bytes_received_from[from_node.id] = 0
+        # hoist the attribute lookups that are repeated on this hot path
+        node_id = from_node.id
+        lora_param = packet.lora_param
 
-        if packet.rss < self.SENSITIVITY[packet.lora_param.sf] or packet.snr < required_snr(packet.lora_param.dr):
+        if weak is None:
+            weak = packet.rss < _SENSITIVITY_TUPLE[lora_param.sf - 6] or packet.snr < required_snr(lora_param.dr)
+        if weak:
             # the packet received is to weak
             downlink_meta_msg.weak_packet = True
-            self.uplink_packet_weak.append(packet)
+            self.uplink_packet_weak_count += 1
             return downlink_msg
 
         self.bytes_received += packet.payload_size
         self.num_of_packet_received += 1
 
         # everytime a distinct message is received (i.e. id is diff from previous message
-        if from_node.id not in self.last_distinct_packets_received_from:
+        if node_id not in self.last_distinct_packets_received_from:
             self.distinct_packets_received += 1
-        elif self.last_distinct_packets_received_from[from_node.id] != packet.id:
+        elif self.last_distinct_packets_received_from[node_id] != packet.id:
             self.distinct_packets_received += 1
-            self.distinct_bytes_received_from[from_node.id] += packet.payload_size
-        self.last_distinct_packets_received_from[from_node.id] = packet.id
+            self.distinct_bytes_received_from[node_id] += packet.payload_size
+        self.last_distinct_packets_received_from[node_id] = packet.id
+
+        idx = self.packet_history_idx[node_id]
+        self.packet_history[node_id][idx % 20] = packet.snr
+        self.packet_history_idx[node_id] = idx + 1
+        self.packet_history_count[node_id] = min(self.packet_history_count[node_id] + 1, 20)
 
-        self.packet_history[from_node.id].append(packet.snr)
+        window = self._snr_max_window[node_id]
+        while window and window[-1][0] <= packet.snr:
+            window.pop()
+        window.append((packet.snr, idx))
+        if idx - window[0][1] >= 20:
+            window.popleft()
 
         if from_node.adr:
             downlink_msg.adr_param = self.adr(packet)
 
         # first compute if DC can be done for RX1 and RX2
-        possible_rx1, time_on_air_rx1, off_time_till_rx1 = self.check_duty_cycle(12, packet.lora_param.sf,
-                                                                                 packet.lora_param.freq,
+        possible_rx1, time_on_air_rx1, off_time_till_rx1 = self.check_duty_cycle(12, lora_param.sf,
+                                                                                 lora_param.freq,
                                                                                  now)
         possible_rx2, time_on_air_rx2, off_time_till_rx2 = self.check_duty_cycle(12, LoRaParameters.RX_2_DEFAULT_SF,
                                                                                  LoRaParameters.RX_2_DEFAULT_FREQ,
-                                                                                 now)
+                                                                                 now, time_on_air=self._rx2_toa)
 
         if not packet.is_confirmed_message:
             # only schedule DL message if number of received msgs is > 20, i.e. every 20
             schedule_dl = False
-            if self.packet_num_received_from[from_node.id] % 20 == 0:
+            if self.packet_num_received_from[node_id] % 20 == 0:
                 schedule_dl = True
-                self.packet_num_received_from[from_node.id] = 0  # count again
+                self.packet_num_received_from[node_id] = 0  # count again
         else:
             schedule_dl = True
 
         tx_on_rx1 = False
         lost = False
 
-        if schedule_dl and not possible_rx1 and not possible_rx2:
-            lost = True
-            self.dl_not_schedulable += 1
-        elif schedule_dl:
-            if packet.lora_param.dr > 3:
-                # we would like sending on the same channel with the same DR
-                if not possible_rx1:
-                    if possible_rx2:
-                        tx_on_rx1 = False
-                else:
-                    tx_on_rx1 = True
-            else:
-                # we would like sending it on RX2 (less robust) but sending with 27dBm
-                if not possible_rx2:
-                    if possible_rx1:
-                        tx_on_rx1 = True
-                else:
-                    tx_on_rx1 = False
+        if schedule_dl:
+            tx_on_rx1, lost = _RX_DECISION[(lora_param.dr > 3, possible_rx1, possible_rx2)]
+            if lost:
+                self.dl_not_schedulable += 1
 
         if not lost:
             if schedule_dl:
                 downlink_meta_msg.scheduled_receive_slot = DownlinkMetaMessage.RX_SLOT_1 if tx_on_rx1 else DownlinkMetaMessage.RX_SLOT_2
                 if tx_on_rx1:
-                    time_off_for_channel = packet.lora_param.freq
+                    time_off_for_channel = lora_param.freq
                     time_off_till = off_time_till_rx1
                 else:
                     time_off_for_channel = LoRaParameters.RX_2_DEFAULT_FREQ
                     time_off_till = off_time_till_rx2
-                self.time_off[time_off_for_channel] = time_off_till
+                self.time_off[self._channel_idx[time_off_for_channel]] = time_off_till
         else:
             downlink_meta_msg.dc_limit_reached = True
         return downlink_msg
 
-    def check_duty_cycle(self, payload_size, sf, freq, now) -> (bool, float, float):
-        from Framework import LoRaPacket
-        time_on_air = LoRaPacket.time_on_air(payload_size, lora_param=LoRaParameters(freq=freq, sf=sf, bw=125, cr=5, crc_enabled=1, de_enabled=0, header_implicit_mode=1))
+    def packets_received_batch(self, nodes, packets, now):
+        """Vectorized fast-path for processing several received packets at once.
+        The weak-packet classification (sensitivity and required SNR checks)
+        is done in a single vector op per check; the per-packet bookkeeping
+        is delegated to packet_received with the precomputed result."""
+        num = len(packets)
+        rss = np.fromiter((packet.rss for packet in packets), dtype=float, count=num)
+        snr = np.fromiter((packet.snr for packet in packets), dtype=float, count=num)
+        sf = np.fromiter((packet.lora_param.sf for packet in packets), dtype=int, count=num)
+        dr = np.fromiter((packet.lora_param.dr for packet in packets), dtype=int, count=num)
+
+        weak = (rss < _SENSITIVITY_ARR[sf - 6]) | (snr < _REQUIRED_SNR_ARR[dr])
+
+        return [self.packet_received(node, packet, now, weak=bool(is_weak))
+                for node, packet, is_weak in zip(nodes, packets, weak)]
+
+    def check_duty_cycle(self, payload_size, sf, freq, now, time_on_air=None) -> (bool, float, float):
         # it is not possible to schedule a message now on this channel for this message
-        if self.time_off[freq] > self.env.now:
-            return False, time_on_air, -1
+        # checked first so the airtime is not computed for a channel that is off anyway
+        if self.time_off[self._channel_idx[freq]] > self.env.now:
+            return False, 0, -1
+
+        if time_on_air is None:
+            time_on_air = _time_on_air_cached(payload_size, sf, freq)
 
         # update time_off time
         # https://github.com/things4u/things4u.github.io/blob/master/DeveloperGuide/LoRa%20documents/LoRaWAN%20Specification%201R0.pdf
@@ -163,68 +290,35 @@ class Gateway:
         return True, time_on_air, off_time_till
 
     def adr(self, packet: UplinkMessage):
-        history = self.packet_history[packet.node.id]
+        node_id = packet.node.id
+        lora_param = packet.lora_param
+        history = self.packet_history[node_id]
+        count = self.packet_history_count[node_id]
 
-        if len(history) == 20 or self.fast_adr_on:
+        if count == 20 or self.fast_adr_on:
             # Execute adr else do nothing
 
+            if count < 20:
+                # fast ADR: only look at the samples written so far
+                history = history[:count]
+
             if self.max_snr_adr:
-                snr_history_val = np.amax(np.asanyarray(history))
+                # the running max is available in O(1) from the monotonic deque
+                snr_history_val = self._snr_max_window[node_id][0][0]
             elif self.min_snr_adr:
-                snr_history_val = np.amin(np.asanyarray(history))
+                snr_history_val = history.min()
             elif self.avg_snr_adr:
-                snr_history_val = np.average(np.asanyarray(history))
+                snr_history_val = history.mean()
             else:
                 # default
-                snr_history_val = np.amax(np.asanyarray(history))
-
-            if packet.lora_param.sf == 7:
-                adr_required_snr = -7.5
-            elif packet.lora_param.sf == 8:
-                adr_required_snr = -10
-            elif packet.lora_param.sf == 9:
-                adr_required_snr = -12.5
-            elif packet.lora_param.sf == 10:
-                adr_required_snr = -15
-            elif packet.lora_param.sf == 11:
-                adr_required_snr = -17.5
-            elif packet.lora_param.sf == 12:
-                adr_required_snr = -20
-            else:
-                ValueError('SF {} not supported'.format(packet.lora_param.sf))
-
-            snr_margin = snr_history_val - adr_required_snr - self.adr_margin_db
-
-            num_steps = np.round(snr_margin / 3)
-            # If NStep > 0 the data rate can be increased and/or power reduced.
-            # If Nstep < 0, power can be increased (to the max.).
-
-            # Note: the data rate is never decreased,
-            # this is done automatically by the node if ADRACKReq's get unacknowledged.
-
-            current_tx_power = packet.lora_param.tp
-            current_dr = packet.lora_param.dr
-            dr_changing = 0
-            new_tx_power = current_tx_power
-            new_dr = current_dr
-
-            if num_steps > 0:
-                # increase data rate by the num_steps until DR5 is reached
-                num_steps_possible_dr = 5 - packet.lora_param.dr
-                if num_steps > num_steps_possible_dr:
-                    dr_changing = num_steps_possible_dr
-                    num_steps_remaining = num_steps - num_steps_possible_dr
-                    decrease_tx_power = num_steps_remaining * 3  # the remainder is used  to decrease the TXpower by
-                    # 3dBm per step, until TXmin is reached. TXmin = 2 dBm for EU868.
-                    new_tx_power = np.amax([current_tx_power - decrease_tx_power, 2])
-                elif num_steps <= num_steps_possible_dr:
-                    dr_changing = num_steps
-                    # use default decrease tx power (0)
-                new_dr = current_dr + dr_changing
-            elif num_steps < 0:
-                # TX power is increased by 3dBm per step, until TXmax is reached (=14 dBm for EU868).
-                num_steps = - num_steps  # invert so we do not need to work with negative numbers
-                new_tx_power = np.amin([current_tx_power + (num_steps * 3), 14])
+                snr_history_val = self._snr_max_window[node_id][0][0]
+
+            adr_required_snr = _ADR_REQ_SNR.get(lora_param.sf)
+            if adr_required_snr is None:
+                ValueError('SF {} not supported'.format(lora_param.sf))
+
+            new_dr, new_tx_power = _adr_kernel(snr_history_val, adr_required_snr, self.adr_margin_db,
+                                               lora_param.tp, lora_param.dr)
             if PRINT_ENABLED:
                 print(str({'dr': new_dr, 'tp': new_tx_power}))
 
@@ -234,13 +328,13 @@ class Gateway:
 
     def log(self):
         print('\n\t\t GATEWAY')
-        print('Received {} packets'.format(self.num_of_packet_received))
-        print('Lost {} downlink packets'.format(self.dl_not_schedulable))
-        if len(self.uplink_packet_weak) != 0 and self.num_of_packet_received != 0:
-            weak_ratio = len(self.uplink_packet_weak) / self.num_of_packet_received
-            print('Ratio Weak/Received is {0:.2f}%'.format(weak_ratio * 100))
+        print(f'Received {self.num_of_packet_received} packets')
+        print(f'Lost {self.dl_not_schedulable} downlink packets')
+        if self.uplink_packet_weak_count != 0 and self.num_of_packet_received != 0:
+            weak_ratio = self.uplink_packet_weak_count / self.num_of_packet_received
+            print(f'Ratio Weak/Received is {weak_ratio * 100:.2f}%')
 
-        print('Bytes received at gateway {0:.2f}'.format(self.bytes_received))
+        print(f'Bytes received at gateway {self.bytes_received:.2f}')
 
     def get_der(self, nodes):
         packets_sent = 0
@@ -253,7 +347,7 @@ class Gateway:
         series = pd.Series({
             'BytesReceived': self.bytes_received,
             'DLPacketsLost': self.dl_not_schedulable,
-            'ULWeakPackets': len(self.uplink_packet_weak),
+            'ULWeakPackets': self.uplink_packet_weak_count,
             'PacketsReceived': self.num_of_packet_received,
             'UniquePacketsReceived': self.distinct_packets_received
         })
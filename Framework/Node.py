@@ -78,9 +78,7 @@ class Node:
 
         self.packet_to_sent = None
 
-        self.time_off = dict()
-        for ch in LoRaParameters.CHANNELS:
-            self.time_off[ch] = 0
+        self.time_off = dict.fromkeys(LoRaParameters.CHANNELS, 0)
 
         self.confirmed_messages = confirmed_messages
 